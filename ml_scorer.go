@@ -7,6 +7,7 @@ import (
 	"os"
 	"regexp"
 	"strings"
+	"unicode/utf8"
 
 	onnxruntime "github.com/yalue/onnxruntime_go"
 )
@@ -177,7 +178,11 @@ func (s *MLScorer) extractFeatures(query, answer string, ragResult *RAGResult, c
 	return features
 }
 
-// calculateQueryCoverage calculates percentage of query terms in answer
+// coverageWordRegex matches words the way Python's Unicode `\w+` does in the
+// training pipeline; RE2's `\w` is ASCII-only and would split "résumé" into "r", "sum"
+var coverageWordRegex = regexp.MustCompile(`[\p{L}\p{N}_]+`)
+
+// calculateQueryCoverage calculates percentage of query terms that appear as words in answer
 func (s *MLScorer) calculateQueryCoverage(query, answer string) float64 {
 	stopwords := map[string]bool{
 		"a": true, "an": true, "and": true, "are": true, "as": true, "at": true,
@@ -188,12 +193,11 @@ func (s *MLScorer) calculateQueryCoverage(query, answer string) float64 {
 	}
 
 	// Extract significant words
-	wordRegex := regexp.MustCompile(`\b\w+\b`)
-	queryWords := wordRegex.FindAllString(strings.ToLower(query), -1)
+	queryWords := coverageWordRegex.FindAllString(strings.ToLower(query), -1)
 
 	var significantWords []string
 	for _, word := range queryWords {
-		if len(word) > 2 && !stopwords[word] {
+		if utf8.RuneCountInString(word) > 2 && !stopwords[word] {
 			significantWords = append(significantWords, word)
 		}
 	}
@@ -202,10 +206,15 @@ func (s *MLScorer) calculateQueryCoverage(query, answer string) float64 {
 		return 0.0
 	}
 
-	answerLower := strings.ToLower(answer)
+	// Match whole words, as the Python pipeline does
+	answerWords := make(map[string]bool)
+	for _, word := range coverageWordRegex.FindAllString(strings.ToLower(answer), -1) {
+		answerWords[word] = true
+	}
+
 	matched := 0
 	for _, word := range significantWords {
-		if strings.Contains(answerLower, word) {
+		if answerWords[word] {
 			matched++
 		}
 	}
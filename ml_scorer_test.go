@@ -0,0 +1,33 @@
+package main
+
+import (
+	"math"
+	"testing"
+)
+
+func TestCalculateQueryCoverageMatchesWholeWords(t *testing.T) {
+	s := &MLScorer{}
+
+	tests := []struct {
+		name   string
+		query  string
+		answer string
+		want   float64
+	}{
+		{"exact words", "vector index", "The Vector index.", 1.0},
+		{"substring is not a match", "testing the vector index", "test vector indexes", 1.0 / 3.0},
+		{"stopwords and short words ignored", "what is it", "anything", 0.0},
+		{"non-ASCII word is one token", "sum", "résumé", 0.0},
+		{"non-ASCII query word", "résumé format", "Send your résumé", 0.5},
+		{"rune length for short words", "né ça résumé", "résumé", 1.0},
+	}
+
+	for _, tt := range tests {
+		t.Run(tt.name, func(t *testing.T) {
+			got := s.calculateQueryCoverage(tt.query, tt.answer)
+			if math.Abs(got-tt.want) > 1e-9 {
+				t.Errorf("calculateQueryCoverage(%q, %q) = %v, want %v", tt.query, tt.answer, got, tt.want)
+			}
+		})
+	}
+}
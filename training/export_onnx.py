@@ -4,20 +4,48 @@ Export trained PyTorch model to ONNX format for Go inference.
 """
 
 import argparse
-import json
+import os
+import orjson
 import torch
+import torch.nn as nn
 import torch.onnx
 import numpy as np
 
 from train_quality_model import QualityMLP
 
 
-def export_pytorch_to_onnx(model_path: str, metadata_path: str, output_path: str):
-    """Export PyTorch model to ONNX format."""
+def prepare_for_export(model: QualityMLP) -> torch.jit.ScriptModule:
+    """
+    Build the inference graph and script it into TorchScript.
+
+    Dropout is replaced with Identity and a Sigmoid is appended to the
+    logit output, so the exported model returns a 0-1 score.
+    """
+    # Dropout is a no-op at inference but still emits an ONNX node that blocks fusions
+    layers = [
+        nn.Identity() if isinstance(layer, nn.Dropout) else layer
+        for layer in model.network
+    ]
+    layers.append(nn.Sigmoid())
+    model.network = nn.Sequential(*layers)
+    # Not frozen: torch.jit.freeze would turn the weights into graph constants,
+    # and the exporter needs them as parameters to emit initializers
+    return torch.jit.script(model.eval())
+
+
+def export_pytorch_to_onnx(model_path: str, metadata_path: str, output_path: str,
+                           batch_size: int = 1, dynamic: bool = False):
+    """
+    Export PyTorch model to ONNX format.
+
+    By default the input shape is fixed to (batch_size, input_size), which
+    lets ONNX Runtime specialize kernels for the Go scorer's single-row calls.
+    Pass dynamic=True to export a variable batch dimension instead.
+    """
 
     # Load metadata to get input size
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
+    with open(metadata_path, 'rb') as f:
+        metadata = orjson.loads(f.read())
 
     input_size = len(metadata['feature_names'])
     print(f"Model input size: {input_size}")
@@ -25,10 +53,17 @@ def export_pytorch_to_onnx(model_path: str, metadata_path: str, output_path: str
     # Create model and load weights
     model = QualityMLP(input_size)
     model.load_state_dict(torch.load(model_path))
-    model.eval()
+    model = prepare_for_export(model)
 
     # Create dummy input for tracing
-    dummy_input = torch.randn(1, input_size)
+    dummy_input = torch.randn(batch_size, input_size)
+
+    dynamic_axes = None
+    if dynamic:
+        dynamic_axes = {
+            'input': {0: 'batch_size'},
+            'output': {0: 'batch_size'}
+        }
 
     # Export to ONNX
     torch.onnx.export(
@@ -36,38 +71,103 @@ def export_pytorch_to_onnx(model_path: str, metadata_path: str, output_path: str
         dummy_input,
         output_path,
         export_params=True,
-        opset_version=11,
+        opset_version=17,
         do_constant_folding=True,
+        training=torch.onnx.TrainingMode.EVAL,
         input_names=['input'],
         output_names=['output'],
-        dynamic_axes={
-            'input': {0: 'batch_size'},
-            'output': {0: 'batch_size'}
-        }
+        dynamic_axes=dynamic_axes
     )
 
     print(f"Model exported to {output_path}")
 
-    # Verify the export
+    # Embed the metadata so the .onnx file is self-contained, then verify
     import onnx
     onnx_model = onnx.load(output_path)
+    embed_metadata(onnx_model, metadata)
+    onnx.save(onnx_model, output_path)
     onnx.checker.check_model(onnx_model)
+    check_weight_initializers(onnx_model)
     print("ONNX model validation: PASSED")
 
-    # Test inference
+    # Compare ONNX Runtime against PyTorch on the dummy input
+    pytorch_output = model(dummy_input).detach().numpy()
+    verify_onnx(output_path, dummy_input.numpy(), pytorch_output, tolerance=1e-5)
+
+    # Post-training dynamic quantization: int8 weights, same float32 input/output
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    int8_path = os.path.splitext(output_path)[0] + '.int8.onnx'
+    quantize_dynamic(output_path, int8_path, weight_type=QuantType.QInt8)
+    int8_model = onnx.load(int8_path)
+    quantized_ops = {'MatMulInteger', 'DynamicQuantizeLinear'}
+    if not any(node.op_type in quantized_ops for node in int8_model.graph.node):
+        # quantize_dynamic silently copies graphs it can't quantize; don't leave a fake int8 model around
+        os.remove(int8_path)
+        raise RuntimeError(f"Quantization produced no int8 ops; {int8_path} would still be float32")
+    embed_metadata(int8_model, metadata)
+    onnx.save(int8_model, int8_path)
+    print(f"Quantized model exported to {int8_path}")
+    verify_onnx(int8_path, dummy_input.numpy(), pytorch_output, tolerance=1e-2)
+
+
+def check_weight_initializers(onnx_model):
+    """
+    Raise if a Gemm/MatMul weight is not a graph initializer.
+
+    Weights folded into Constant nodes still run, but ONNX Runtime's dynamic
+    quantization only quantizes weights stored as initializers.
+    """
+    initializers = {init.name for init in onnx_model.graph.initializer}
+    for node in onnx_model.graph.node:
+        if node.op_type in ('Gemm', 'MatMul') and node.input[1] not in initializers:
+            raise RuntimeError(
+                f"{node.op_type} node '{node.name}' weight '{node.input[1]}' is not an initializer"
+            )
+
+
+def embed_metadata(onnx_model, metadata: dict):
+    """
+    Store feature names and normalization parameters in the model's metadata_props.
+
+    Each entry is a JSON-encoded value under the same key as in model_metadata.json,
+    so inference code can read everything from the .onnx file alone.
+    """
+    props = {prop.key: prop.value for prop in onnx_model.metadata_props}
+    for key in ('feature_names', 'mean', 'std'):
+        props[key] = orjson.dumps(metadata[key]).decode()
+
+    del onnx_model.metadata_props[:]
+    for key, value in props.items():
+        prop = onnx_model.metadata_props.add()
+        prop.key = key
+        prop.value = value
+
+
+def verify_onnx(onnx_path: str, input_data: np.ndarray, expected: np.ndarray, tolerance: float):
+    """Run an ONNX model on input_data and compare with the PyTorch output."""
     import onnxruntime as ort
-    session = ort.InferenceSession(output_path)
+
+    # Same settings the Go scorer should use: full graph optimization, and a
+    # single intra-op thread since the model is too small to benefit from more
+    sess_opts = ort.SessionOptions()
+    sess_opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    sess_opts.intra_op_num_threads = 1
+    session = ort.InferenceSession(onnx_path, sess_opts, providers=['CPUExecutionProvider'])
+
+    # Bind a pre-allocated input and let ORT allocate the output once
+    io_binding = session.io_binding()
+    io_binding.bind_ortvalue_input('input', ort.OrtValue.ortvalue_from_numpy(input_data))
+    io_binding.bind_output('output')
 
     # Run test inference
-    input_data = dummy_input.numpy()
-    onnx_output = session.run(['output'], {'input': input_data})[0]
-    pytorch_output = model(dummy_input).detach().numpy()
+    session.run_with_iobinding(io_binding)
+    onnx_output = io_binding.copy_outputs_to_cpu()[0]
 
     # Compare outputs
-    diff = np.abs(onnx_output - pytorch_output).max()
-    print(f"Max difference between PyTorch and ONNX: {diff:.6f}")
+    diff = np.abs(onnx_output - expected).max()
+    print(f"Max difference between PyTorch and {onnx_path}: {diff:.6f}")
 
-    if diff < 1e-5:
+    if diff < tolerance:
         print("Export verification: PASSED")
     else:
         print("Warning: Outputs differ significantly")
@@ -88,8 +188,8 @@ def export_sklearn_to_onnx(model_path: str, metadata_path: str, output_path: str
         model = pickle.load(f)
 
     # Load metadata
-    with open(metadata_path, 'r') as f:
-        metadata = json.load(f)
+    with open(metadata_path, 'rb') as f:
+        metadata = orjson.loads(f.read())
 
     input_size = len(metadata['feature_names'])
 
@@ -98,6 +198,7 @@ def export_sklearn_to_onnx(model_path: str, metadata_path: str, output_path: str
 
     # Convert to ONNX
     onnx_model = convert_sklearn(model, initial_types=initial_type)
+    embed_metadata(onnx_model, metadata)
 
     # Save
     with open(output_path, 'wb') as f:
@@ -115,18 +216,23 @@ def main():
                         help='Output ONNX file path')
     parser.add_argument('--type', choices=['pytorch', 'sklearn'], default='pytorch',
                         help='Model type')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Fixed input batch size (PyTorch only)')
+    parser.add_argument('--dynamic', action='store_true',
+                        help='Export a variable batch dimension instead of a fixed one (PyTorch only)')
 
     args = parser.parse_args()
 
     if args.type == 'pytorch':
-        export_pytorch_to_onnx(args.model, args.metadata, args.output)
+        export_pytorch_to_onnx(args.model, args.metadata, args.output,
+                               batch_size=args.batch_size, dynamic=args.dynamic)
     else:
         export_sklearn_to_onnx(args.model, args.metadata, args.output)
 
     print("\nNext steps:")
     print("  1. Copy training/quality_model.onnx to your Go project")
     print("  2. Copy training/model_metadata.json to your Go project")
-    print("  3. Use the ONNX runtime in Go to load and run inference")
+    print("  3. Use the ONNX runtime in Go to load and run inference (create one session and reuse it)")
 
 
 if __name__ == "__main__":
@@ -5,20 +5,24 @@ Supports both simple (logistic regression) and neural network models.
 """
 
 import argparse
-import json
 import numpy as np
+import orjson
 import torch
 import torch.nn as nn
-from sklearn.model_selection import train_test_split
+from torch.utils.data import DataLoader, TensorDataset
 from sklearn.linear_model import Ridge
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
-import matplotlib.pyplot as plt
 
 from feature_engineering import load_ratings, extract_features_batch, normalize_features
 
 
 class QualityMLP(nn.Module):
-    """Multi-layer perceptron for quality prediction."""
+    """
+    Multi-layer perceptron for quality prediction.
+
+    Outputs raw logits so training can use the fused BCEWithLogitsLoss;
+    apply a sigmoid to get a 0-1 score (export_onnx appends one).
+    """
 
     def __init__(self, input_size: int, hidden_sizes: list = [32, 16]):
         super(QualityMLP, self).__init__()
@@ -33,28 +37,75 @@ class QualityMLP(nn.Module):
             prev_size = hidden_size
 
         layers.append(nn.Linear(prev_size, 1))
-        layers.append(nn.Sigmoid())  # Output 0-1
 
         self.network = nn.Sequential(*layers)
 
     def forward(self, x):
-        return self.network(x).squeeze()
+        return self.network(x).squeeze(-1)
+
+
+class TrainStep(nn.Module):
+    """Forward pass and loss for one batch, as a single module to trace or compile."""
+
+    def __init__(self, model: nn.Module, criterion: nn.Module):
+        super(TrainStep, self).__init__()
+        self.model = model
+        self.criterion = criterion
+
+    def forward(self, x, y):
+        return self.criterion(self.model(x), y)
+
+
+def build_train_step(model: nn.Module, criterion: nn.Module, example, use_compile=False) -> nn.Module:
+    """
+    Wrap forward + loss into one graph per optimizer step.
+
+    The step is traced into TorchScript by default. With use_compile it is
+    built with torch.compile instead, falling back to the traced step if
+    compilation fails (e.g. no C++ toolchain). model must be in train mode.
+    """
+    step = TrainStep(model, criterion)
+
+    if use_compile:
+        try:
+            compiled = torch.compile(step, fullgraph=True)
+            # Compilation is lazy; run it once now so a missing toolchain fails here
+            compiled(*example)
+            return compiled
+        except Exception as e:
+            print(f"Warning: torch.compile failed, using the traced training step instead: {e}")
+
+    # Dropout makes the traced outputs nondeterministic, so skip the trace check
+    return torch.jit.trace(step, example, check_trace=False)
+
+
+def _pyplot():
+    """Import pyplot on first use, with the non-interactive Agg backend."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 def train_linear_model(X_train, y_train, X_test, y_test):
     """Train a simple linear regression model."""
     print("Training Ridge Regression model...")
 
-    model = Ridge(alpha=1.0)
+    # Closed-form Cholesky solve in float32: fastest for a few thousand rows x 15 features
+    X_train = X_train.astype(np.float32, copy=False)
+    y_train = y_train.astype(np.float32, copy=False)
+    X_test = X_test.astype(np.float32, copy=False)
+
+    model = Ridge(alpha=1.0, solver='cholesky')
     model.fit(X_train, y_train)
 
     # Evaluate
     y_pred_train = model.predict(X_train)
     y_pred_test = model.predict(X_test)
 
-    # Clip predictions to [0, 1]
-    y_pred_train = np.clip(y_pred_train, 0, 1)
-    y_pred_test = np.clip(y_pred_test, 0, 1)
+    # Clip predictions to [0, 1] (in place, predict() already returned fresh arrays)
+    np.clip(y_pred_train, 0, 1, out=y_pred_train)
+    np.clip(y_pred_test, 0, 1, out=y_pred_test)
 
     train_mae = mean_absolute_error(y_train, y_pred_train)
     test_mae = mean_absolute_error(y_test, y_pred_test)
@@ -67,51 +118,74 @@ def train_linear_model(X_train, y_train, X_test, y_test):
     return model, y_pred_test
 
 
-def train_neural_network(X_train, y_train, X_test, y_test, epochs=100, lr=0.001):
-    """Train a neural network model."""
+def train_neural_network(X_train, y_train, X_test, y_test, epochs=100, lr=0.001,
+                         batch_size=128, eval_every=10, plot=False, compile_step=False):
+    """Train a neural network model with mini-batch Adam."""
     print("Training Neural Network model...")
 
     input_size = X_train.shape[1]
     model = QualityMLP(input_size)
 
-    # Convert to PyTorch tensors
-    X_train_t = torch.FloatTensor(X_train)
-    y_train_t = torch.FloatTensor(y_train)
-    X_test_t = torch.FloatTensor(X_test)
-    y_test_t = torch.FloatTensor(y_test)
+    # Convert to contiguous PyTorch tensors (shares memory with float32 inputs)
+    X_train_t = torch.as_tensor(X_train, dtype=torch.float32).contiguous()
+    y_train_t = torch.as_tensor(y_train, dtype=torch.float32).contiguous()
+    X_test_t = torch.as_tensor(X_test, dtype=torch.float32).contiguous()
+    y_test_t = torch.as_tensor(y_test, dtype=torch.float32).contiguous()
+
+    train_loader = DataLoader(
+        TensorDataset(X_train_t, y_train_t),
+        batch_size=batch_size,
+        shuffle=True,
+        num_workers=0,
+        pin_memory=False,
+    )
 
-    criterion = nn.MSELoss()
+    criterion = nn.BCEWithLogitsLoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
+    # Parameters are shared with the traced/compiled step, and the eager
+    # model is what gets evaluated and returned for export
+    model.train()
+    loss_step = build_train_step(
+        model, criterion, (X_train_t[:batch_size], y_train_t[:batch_size]), use_compile=compile_step
+    )
+
     train_losses = []
     test_losses = []
+    eval_epochs = []
 
     for epoch in range(epochs):
         # Training
         model.train()
-        optimizer.zero_grad()
-        outputs = model(X_train_t)
-        loss = criterion(outputs, y_train_t)
-        loss.backward()
-        optimizer.step()
+        epoch_loss = 0.0
+        for xb, yb in train_loader:
+            optimizer.zero_grad(set_to_none=True)
+            loss = loss_step(xb, yb)
+            loss.backward()
+            optimizer.step()
+            epoch_loss += loss.item() * len(xb)
+
+        train_loss = epoch_loss / len(X_train_t)
+        train_losses.append(train_loss)
 
-        train_losses.append(loss.item())
+        # Validation (only on logged epochs)
+        if (epoch + 1) % eval_every != 0 and epoch + 1 != epochs:
+            continue
 
-        # Validation
         model.eval()
-        with torch.no_grad():
+        with torch.inference_mode():
             test_outputs = model(X_test_t)
-            test_loss = criterion(test_outputs, y_test_t)
-            test_losses.append(test_loss.item())
+            test_loss = criterion(test_outputs, y_test_t).item()
+        test_losses.append(test_loss)
+        eval_epochs.append(epoch)
 
-        if (epoch + 1) % 10 == 0:
-            print(f"Epoch [{epoch+1}/{epochs}] Train Loss: {loss.item():.4f}, Test Loss: {test_loss.item():.4f}")
+        print(f"Epoch [{epoch+1}/{epochs}] Train Loss: {train_loss:.4f}, Test Loss: {test_loss:.4f}")
 
     # Final evaluation
     model.eval()
-    with torch.no_grad():
-        y_pred_train = model(X_train_t).numpy()
-        y_pred_test = model(X_test_t).numpy()
+    with torch.inference_mode():
+        y_pred_train = model(X_train_t).sigmoid_().numpy()
+        y_pred_test = model(X_test_t).sigmoid_().numpy()
 
     train_mae = mean_absolute_error(y_train, y_pred_train)
     test_mae = mean_absolute_error(y_test, y_pred_test)
@@ -123,21 +197,29 @@ def train_neural_network(X_train, y_train, X_test, y_test, epochs=100, lr=0.001)
     print(f"Test MAE: {test_mae:.4f}, R²: {test_r2:.4f}")
 
     # Plot training curve
+    if plot:
+        plot_training_curve(train_losses, eval_epochs, test_losses)
+
+    return model, y_pred_test, (train_losses, test_losses)
+
+
+def plot_training_curve(train_losses, eval_epochs, test_losses, output_path='training/training_curve.png'):
+    """Plot train loss per epoch and test loss at evaluated epochs."""
+    plt = _pyplot()
     plt.figure(figsize=(10, 5))
     plt.plot(train_losses, label='Train Loss')
-    plt.plot(test_losses, label='Test Loss')
+    plt.plot(eval_epochs, test_losses, label='Test Loss')
     plt.xlabel('Epoch')
-    plt.ylabel('MSE Loss')
+    plt.ylabel('BCE Loss')
     plt.legend()
     plt.title('Training Progress')
-    plt.savefig('training/training_curve.png')
-    print("Training curve saved to training/training_curve.png")
-
-    return model, y_pred_test, (train_losses, test_losses)
+    plt.savefig(output_path)
+    print(f"Training curve saved to {output_path}")
 
 
 def plot_predictions(y_true, y_pred, output_path='training/predictions.png'):
     """Plot predicted vs actual ratings."""
+    plt = _pyplot()
     plt.figure(figsize=(8, 8))
     plt.scatter(y_true, y_pred, alpha=0.5)
     plt.plot([0, 1], [0, 1], 'r--', label='Perfect prediction')
@@ -150,16 +232,19 @@ def plot_predictions(y_true, y_pred, output_path='training/predictions.png'):
     print(f"Predictions plot saved to {output_path}")
 
 
-def save_model_metadata(feature_names, mean, std, output_path='training/model_metadata.json'):
-    """Save feature names and normalization parameters."""
+def save_model_metadata(feature_names, mean, std, test_indices=None,
+                        output_path='training/model_metadata.json'):
+    """Save feature names, normalization parameters and the held-out test rows."""
     metadata = {
         'feature_names': feature_names,
-        'mean': mean.tolist(),
-        'std': std.tolist(),
+        'mean': mean,
+        'std': std,
     }
+    if test_indices is not None:
+        metadata['test_indices'] = test_indices
 
-    with open(output_path, 'w') as f:
-        json.dump(metadata, f, indent=2)
+    with open(output_path, 'wb') as f:
+        f.write(orjson.dumps(metadata, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
     print(f"Model metadata saved to {output_path}")
 
@@ -170,7 +255,12 @@ def main():
     parser.add_argument('--model', choices=['linear', 'nn'], default='nn', help='Model type')
     parser.add_argument('--epochs', type=int, default=100, help='Training epochs (NN only)')
     parser.add_argument('--lr', type=float, default=0.001, help='Learning rate (NN only)')
+    parser.add_argument('--batch-size', type=int, default=128, help='Mini-batch size (NN only)')
     parser.add_argument('--test-size', type=float, default=0.2, help='Test set proportion')
+    parser.add_argument('--compile', action='store_true',
+                        help='Build the training step with torch.compile instead of tracing it (NN only, needs a C++ toolchain)')
+    parser.add_argument('--plot', action='store_true',
+                        help='Save training curve and predictions plots (requires matplotlib)')
 
     args = parser.parse_args()
 
@@ -188,12 +278,20 @@ def main():
     print(f"Extracted {X.shape[1]} features from {X.shape[0]} samples")
 
     # Normalize
-    X_normalized, mean, std = normalize_features(X)
+    X_normalized, mean, std = normalize_features(X, inplace=True)
+
+    # Split with a seeded boolean mask: rows keep their original order and
+    # each side is gathered in a single indexing pass
+    rng = np.random.default_rng(42)
+    train_mask = rng.random(len(X_normalized)) >= args.test_size
+    n_test = int((~train_mask).sum())
+    if n_test < 2 or n_test == len(train_mask):
+        print(f"Error: Train/test split gave {n_test} test samples out of {len(train_mask)}; "
+              "need at least 2 and a non-empty train set. Adjust --test-size or add ratings")
+        return
 
-    # Split
-    X_train, X_test, y_train, y_test = train_test_split(
-        X_normalized, y, test_size=args.test_size, random_state=42
-    )
+    X_train, X_test = X_normalized[train_mask], X_normalized[~train_mask]
+    y_train, y_test = y[train_mask], y[~train_mask]
 
     print(f"\nTrain set: {len(X_train)} samples")
     print(f"Test set: {len(X_test)} samples")
@@ -204,19 +302,22 @@ def main():
     else:
         model, y_pred, losses = train_neural_network(
             X_train, y_train, X_test, y_test,
-            epochs=args.epochs, lr=args.lr
+            epochs=args.epochs, lr=args.lr, batch_size=args.batch_size, plot=args.plot,
+            compile_step=args.compile
         )
 
     # Plot results
-    plot_predictions(y_test, y_pred)
+    if args.plot:
+        plot_predictions(y_test, y_pred)
 
     # Save metadata
-    save_model_metadata(feature_names, mean, std)
+    save_model_metadata(feature_names, mean, std, test_indices=np.flatnonzero(~train_mask))
 
     print("\nTraining complete!")
     print("Next steps:")
-    print("  1. Review training/predictions.png to check model performance")
-    print("  2. Run export_onnx.py to convert the model for Go inference")
+    if args.plot:
+        print("  - Review training/predictions.png to check model performance")
+    print("  - Run export_onnx.py to convert the model for Go inference")
 
 
 if __name__ == "__main__":